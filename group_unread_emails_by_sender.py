@@ -21,28 +21,75 @@ import imaplib
 import ssl
 import time
 import re
-from collections import defaultdict
-
-EMAIL_PATTERN = re.compile(r'<.+?>')
-PROHIBITED_CHARACTERS_PATTERN = re.compile(r'[\W_]')
+from itertools import groupby, islice
+from operator import itemgetter
+from email.utils import parseaddr
+
+# if available, use Google's RE2 engine, which runs in linear time, to sanitize email addresses taken from
+# untrusted message headers. RE2's \W only covers ASCII characters, so its pattern spells out the Unicode
+# letter and number categories to match the same characters as Python's [\W_]
+try:
+    import re2 as re_engine
+    PROHIBITED_CHARACTERS = r'[^\pL\pN]'
+except ImportError:
+    re_engine = re
+    PROHIBITED_CHARACTERS = r'[\W_]'
+
+LIST_RESPONSE_PATTERN = re.compile(rb'^\([^)]*\) (?:"[^"]*"|NIL) "?(.+?)"?$')
+PROHIBITED_CHARACTERS_PATTERN = re_engine.compile(PROHIBITED_CHARACTERS)
 TRANSLATIONS = {'-':'DASH', '.':'DOT', '@':'AT'}
-TRANSLATABLE_CHARACTERS_PATTERN = re.compile(fr'[{"".join(key for key in TRANSLATIONS)}]')
+ADDRESS_HEADER_FIELDS = ['from', 'return-path']
 MAILBOX_PREFIX = 'Unread/'
-
-# given a match object from a call to re.Pattern.sub, look up the match string in TRANSLATIONS and return
-# the translation, if applicable (e.g. if the replacement character is "_", then "." translates to "_DOT_")
-def translate_match(m):
-    group = m.group()
-    translation = TRANSLATIONS.get(group)
-    if translation:
-        return f"{_replacement_character}{translation}{_replacement_character}"
-
-    return group
+BATCH_SIZE = 100
+PIPELINE_WINDOW = 14
+
+# split an iterable into lists of at most n items each, preserving order
+def batched(iterable, n):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, n))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, n))
+
+# build a function that replaces non-alphanumeric characters in an email address with their translation, if
+# applicable (e.g. if the replacement character is "_", then "." -> "_DOT_"), or just replaces them with the
+# replacement character otherwise
+def make_sanitizer(replacement_character):
+    replacements = {key: f"{replacement_character}{translation}{replacement_character}"
+                    for key, translation in TRANSLATIONS.items()}
+    get_replacement = replacements.get
+    prohibited_characters_sub = PROHIBITED_CHARACTERS_PATTERN.sub
+
+    # every translatable character is also a prohibited character, so both kinds of replacement are made in a
+    # single pass over the address
+    def replace_match(m):
+        return get_replacement(m.group(), replacement_character)
+
+    def sanitize(address):
+        return prohibited_characters_sub(replace_match, address)
+
+    return sanitize
+
+# split the raw header fields returned by an IMAP server into a mapping between (lowercase) field names and their
+# values. Folded values that continue over multiple lines are joined back into one line
+def parse_header_fields(header):
+    fields = {}
+    name = None
+    for line in header.split('\r\n'):
+        if line[:1] in (' ', '\t'):
+            if name is not None:
+                fields[name] += line
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            fields[name] = value
+
+    return fields
 
 # create a mapping between sender/return-path email addresses (taken from a list of data from an IMAP server)
-# and the UIDs of the emails sent by those addresses
-def extract_email_addresses(data, uid_iterator):
-    address_to_uid = defaultdict(list)
+# and the UIDs of the emails sent by those addresses. The sender's address is preferred over the return-path
+def extract_email_addresses(data, uid_iterator, sanitize):
+    address_uid_pairs = []
     leftovers = []
     i = 0
 
@@ -50,98 +97,176 @@ def extract_email_addresses(data, uid_iterator):
         uid = next(uid_iterator)
         item = data[i]
         if isinstance(item, tuple):
-            # the message has the expected attribute (sender/return-path) containing the email address
-            item = bytes.decode(item[1])
-            match = EMAIL_PATTERN.search(item)
-            if match:
-                # the email address is between < and >
-                address = match.group()[1:-1]
-            else:
-                # the email address is listed without < and >
-                address = item.split()[-1]
-
-            # replace non-alphanumeric characters in the sender's address with their translation, if applicable
-            # (e.g. "." -> "_DOT_"), or just replace with the replacement character (e.g. "_") otherwise
-            sanitized_address = TRANSLATABLE_CHARACTERS_PATTERN.sub(translate_match, address)
-            sanitized_address = PROHIBITED_CHARACTERS_PATTERN.sub(_replacement_character, sanitized_address)
-
-            address_to_uid[sanitized_address].append(uid)
+            fields = parse_header_fields(item[1].decode('utf-8', 'replace'))
             i += 2
         else:
-            # the message does not have the expected attribute. store the uid for later processing
-            leftovers.append(uid)
+            fields = {}
             i += 1
 
+        # take the email address out of the first header field that contains one
+        for name in ADDRESS_HEADER_FIELDS:
+            address = parseaddr(fields.get(name, ''))[1]
+            if address:
+                break
+        else:
+            # the message has neither a sender nor a return-path. store the uid so it can be reported later
+            leftovers.append(uid)
+            continue
+
+        address_uid_pairs.append((sanitize(address), uid))
+
+    # group the uids by address. The sort is stable, so each address's uids stay in the order they were received
+    address_uid_pairs.sort(key=itemgetter(0))
+    address_to_uid = {address: [uid for _, uid in pairs] for address, pairs in groupby(address_uid_pairs, itemgetter(0))}
+
     return address_to_uid, leftovers
 
 # main function
 def group_unread_emails_by_sender(mail_server, tls_port, email_address, password, wait_time, replacement_character):
-    global _replacement_character
-    _replacement_character = replacement_character
+    sanitize = make_sanitizer(replacement_character)
 
     context = ssl.create_default_context()
     with imaplib.IMAP4_SSL(mail_server, tls_port, ssl_context=context) as client:
         client.login(email_address, password)
         client.select()
 
-        # wait for a predetermined amount of time, and then issue the next IMAP command.
-        # Print the server response, the issued command, and an abbreviated version of
-        # the command arguments to stdout
-        def pause_and_print(function_name, *args):
-            time.sleep(wait_time)
-            tag, data = client.__getattribute__(function_name)(*args)
+        # wait until at least wait_time seconds have passed since the last command (or window of commands) was sent
+        # to the server. Time already spent waiting for the server to respond counts towards wait_time
+        last_send_time = time.monotonic() - wait_time
+        def throttle():
+            nonlocal last_send_time
+            remaining_time = wait_time - (time.monotonic() - last_send_time)
+            if remaining_time > 0:
+                time.sleep(remaining_time)
+
+            last_send_time = time.monotonic()
+
+        # describe the server response, the issued command, and an abbreviated version of the command arguments
+        def describe_call(tag, function_name, args):
+            return ' '.join([f'{tag} {function_name}:'] + [str(a)[:40] for a in args])
 
-            call_info = ' '.join([f'{tag} {function_name}:'] + [str(a)[:40] for a in args])
+        # print the description of a command to stdout
+        def check_and_print(tag, function_name, args):
+            call_info = describe_call(tag, function_name, args)
             if tag == 'NO':
                 raise Exception(call_info)
 
             print(call_info)
+
+        # wait for the throttle, and then issue the next IMAP command
+        def pause_and_print(function_name, *args):
+            throttle()
+            tag, data = client.__getattribute__(function_name)(*args)
+            check_and_print(tag, function_name, args)
+            return data
+
+        # wait for the throttle, and then issue a window of IMAP commands without waiting for the response to each
+        # one (RFC 3501, section 5.5). Return the (response, data) pair of every command, in the order the commands
+        # were sent. command_name is the raw IMAP command, e.g. 'UID'. imaplib's public methods block until the
+        # response to each command arrives, so its internal _command (send a command and return its tag) and
+        # _command_complete (read responses until the one for the given tag arrives) are used to split the two steps.
+        # Every response is read, even after a failure, so that no command is left in flight
+        def pipeline(command_name, args_list):
+            throttle()
+            tags = [client._command(command_name, *args) for args in args_list]
+            responses = []
+            for tag in tags:
+                try:
+                    responses.append(client._command_complete(command_name, tag))
+                except client.abort:
+                    raise
+                except client.error as e:
+                    # imaplib raises an exception for a BAD response instead of returning it
+                    responses.append(('BAD', [str(e).encode()]))
+
+            return responses
+
+        # issue a window of pipelined IMAP commands and print the description of each one to stdout. If any of the
+        # commands failed, raise a single exception listing all of them
+        def pipeline_and_print(command_name, args_list):
+            failures = []
+            for (tag, _), args in zip(pipeline(command_name, args_list), args_list):
+                call_info = describe_call(tag, command_name.lower(), args)
+                if tag == 'OK':
+                    print(call_info)
+                else:
+                    failures.append(call_info)
+
+            if failures:
+                raise Exception('\n'.join(failures))
+
+        # create the given mailboxes, PIPELINE_WINDOW at a time. The server refuses to create a mailbox that already
+        # exists: this is detected by the [ALREADYEXISTS] response code (RFC 5530) or, for servers that don't send
+        # that code, by listing the mailboxes under MAILBOX_PREFIX once, after all the mailboxes have been created
+        def create_mailboxes(mailbox_names):
+            refusals = []
+            for window in batched(mailbox_names, PIPELINE_WINDOW):
+                args_list = [(mailbox_name,) for mailbox_name in window]
+                for (tag, data), args in zip(pipeline('CREATE', args_list), args_list):
+                    if tag == 'OK':
+                        print(describe_call(tag, 'create', args))
+                    elif tag == 'NO' and any(isinstance(d, bytes) and b'[ALREADYEXISTS]' in d for d in data):
+                        print(describe_call(tag, 'create', args), '(already exists)')
+                    else:
+                        refusals.append((tag, args))
+
+            if not refusals:
+                return
+
+            extant_mailboxes = set()
+            for line in pause_and_print('list', '""', f'"{MAILBOX_PREFIX}*"'):
+                # each line looks like: (<flags>) "<hierarchy delimiter>" "<mailbox name>"
+                match = LIST_RESPONSE_PATTERN.match(line) if isinstance(line, bytes) else None
+                if match:
+                    extant_mailboxes.add(match.group(1).decode('ascii', 'replace'))
+
+            failures = []
+            for tag, args in refusals:
+                if args[0] in extant_mailboxes:
+                    print(describe_call(tag, 'create', args), '(already exists)')
+                else:
+                    failures.append(describe_call(tag, 'create', args))
+
+            if failures:
+                raise Exception('\n'.join(failures))
+
+        # fetch the given message data items of the given messages, BATCH_SIZE UIDs at a time, so as not to exceed the
+        # server's maximum request size. The order of the returned data matches the order of the given uids
+        def fetch_in_batches(uids, message_parts):
+            data = []
+            for batch in batched(uids, BATCH_SIZE):
+                data.extend(pause_and_print('uid', 'fetch', ','.join(batch), message_parts))
+
             return data
 
         # get list of all unread emails
         search_data = pause_and_print('uid', 'search', 'unseen')
-        unseen_message_uids = bytes.decode(search_data[0]).split()
-
-        # fetch the 'from' address of all unread emails
-        # the order of from_data matches the order of the uids returned from the search operation
-        from_data = pause_and_print('uid', 'fetch', ','.join(unseen_message_uids), "(BODY.PEEK[HEADER.FIELDS (FROM)])")
-        iter_unseen_message_uids = iter(unseen_message_uids)
-        from_address_to_uid, return_path_uids = extract_email_addresses(from_data, iter_unseen_message_uids)
-
-        # if any emails didn't have a 'from' address, try to fetch their return-path instead
-        return_path_data = pause_and_print('uid', 'fetch', ','.join(return_path_uids), "(BODY.PEEK[HEADER.FIELDS (RETURN-PATH)])")
-        iter_return_path_uids = iter(return_path_uids)
-        return_path_address_to_uid, leftovers = extract_email_addresses(return_path_data, iter_return_path_uids)
-
-        # collect existing mailbox names
-        mailbox_data = pause_and_print('list')
-        extant_mailboxes = set()
-        for line in mailbox_data:
-            line = bytes.decode(line)
-            quote_counter = 0
-            for i, c in enumerate(line):
-                if c == '"':
-                    quote_counter += 1
-                if quote_counter == 3:
-                    break
-
-            extant_mailboxes.add(line[i:][1:-1])
-
-        # create mailboxes based on sender email addresses, and list all the unread emails from those senders in the
+        unseen_message_uids = search_data[0].decode('ascii').split()
+
+        # fetch the 'from' address and the return-path of all unread emails. The return-path is used for any emails
+        # that don't have a 'from' address. The order of header_data matches the order of the uids returned from the
+        # search operation
+        header_data = fetch_in_batches(unseen_message_uids,
+                                       f"(BODY.PEEK[HEADER.FIELDS ({' '.join(ADDRESS_HEADER_FIELDS).upper()})])")
+        address_to_uid, leftovers = extract_email_addresses(header_data, iter(unseen_message_uids), sanitize)
+
+        # create mailboxes based on sender email addresses
+        create_mailboxes([MAILBOX_PREFIX + address for address in address_to_uid])
+
+        # split the unread emails from those senders into batches of BATCH_SIZE UIDs to be moved to the
         # appropriate mailbox
-        for address_to_uid in [from_address_to_uid, return_path_address_to_uid]:
-            for address, uids in address_to_uid.items():
-                mailbox_name = MAILBOX_PREFIX + address
-                if mailbox_name not in extant_mailboxes:
-                    pause_and_print('create', mailbox_name)
-                    extant_mailboxes.add(mailbox_name)
-
-                # we must copy messages to their new mailbox and then delete from inbox one at a time,
-                # or else we could exceed available disk space
-                for uid in uids:
-                    pause_and_print('uid', 'copy', uid, mailbox_name)
-                    pause_and_print('uid', 'store', uid, '+FLAGS.SILENT', r'(\Deleted)')
-                    pause_and_print('expunge')
+        moves = []
+        for address, uids in address_to_uid.items():
+            for batch in batched(uids, BATCH_SIZE):
+                moves.append((','.join(batch), MAILBOX_PREFIX + address))
+
+        # copy messages to their new mailboxes and then delete them from inbox, PIPELINE_WINDOW batches at a time.
+        # Every copy in a window must succeed before any of its messages are flagged for deletion, and expunging
+        # after every window keeps the number of duplicated messages bounded, so we don't exceed available disk space
+        for window in batched(moves, PIPELINE_WINDOW):
+            pipeline_and_print('UID', [('COPY', uid_set, mailbox_name) for uid_set, mailbox_name in window])
+            pipeline_and_print('UID', [('STORE', uid_set, '+FLAGS.SILENT', r'(\Deleted)') for uid_set, _ in window])
+            pause_and_print('expunge')
 
     print('Done.')
     if leftovers:
@@ -186,8 +311,9 @@ if __name__ == '__main__':
         'and trailing underscores in those strings are defaults: they will always match the supplied replacement '
         'character.',
 
-        'Unread emails are moved to their respective folders one at a time, instead of in groups. '
-        f'So if you have a lot of unread emails, then depending on {WAIT_TIME}, this script could take a long time.'
+        'Unread emails are moved to their respective folders in groups of at most '
+        f'{BATCH_SIZE}, and the commands for up to {PIPELINE_WINDOW} groups are sent to the mail server at once. '
+        f'So if you have a lot of unread senders, then depending on {WAIT_TIME}, this script could take a long time.'
     )
 
     parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, description=description, epilog=epilog)
@@ -197,7 +323,7 @@ if __name__ == '__main__':
                         type=int)
     parser.add_argument('EMAIL_ADDRESS', help='your full email address')
     parser.add_argument('PASSWORD', help='the password to your email account')
-    parser.add_argument('-w', WAIT_TIME, help='how many seconds to wait between each command sent to the mail server '
+    parser.add_argument('-w', WAIT_TIME, help='the minimum number of seconds between each command sent to the mail server '
                         f'(default: {WAIT_TIME_DEFAULT})', type=float, default=WAIT_TIME_DEFAULT)
     parser.add_argument('-r', '--replacement-character', help='the character that replaces non-letter and non-numeral '
                         f'characters when naming folders after email senders (default: "{REPLACEMENT_CHARACTER_DEFAULT}")',